@@ -6,12 +6,16 @@ Cliente UART - Con protocolo ACK bidireccional
 
 import serial
 import time
-import struct
 import logging
 from datetime import datetime
 import argparse
-import subprocess
 import os
+import select
+import fcntl
+import termios
+import threading
+import queue
+import zlib
 
 # Logging
 logging.basicConfig(
@@ -23,20 +27,101 @@ logging.basicConfig(
 CMD_START = "FOTO:"
 RESP_OK = "OK|"
 RESP_BAD = "BAD|"
+RESP_BUSY = "BUSY"  # Latido del servidor mientras captura
 TIMEOUT_RESP = 15
 START_MARKER = b'\xAA' * 10
+RETRY_MARKER = b'\xCC' * 4
+END_MARKER = b'\xBB' * 10
+END_TEXT = b"<FIN_TRANSMISION>"
 SIZE_BYTES = 4
 
-# Protocolo ACK
-ACK_READY = "ACK_READY"
-ACK_OK = "ACK_OK"
-ACK_MISSING = "ACK_MISSING:"
-ACK_ERROR = "ACK_ERROR"
+# Protocolo ACK (mensajes ya codificados)
+ACK_READY = b"ACK_READY\r\n"
+ACK_OK = b"ACK_OK\r\n"
+ACK_MISSING = b"ACK_MISSING:%d\r\n"
+ACK_ERROR = b"ACK_ERROR\r\n"
+MAX_CORRECTIONS = 2  # igual a max_retries del servidor
+MAX_IMAGE_SIZE = 64 * 1024 * 1024  # Tope del buffer de recepción si no hay OK|size
+TAIL_TIMEOUT = 5  # Espera máxima de END_MARKER + CRC32 + END_TEXT tras los datos
 
 # Delimitadores de comando
 CMD_BEGIN = "<"
 CMD_END = ">"
 
+class _BlockWriter:
+    """Hilo de escritura a disco: recibe bloques (offset, datos) por cola.
+
+    pwritev libera el GIL, así que el disco avanza mientras el hilo principal
+    sigue en poll()/readv sobre la UART; los bloques contiguos que se
+    acumulan en la cola salen en una sola llamada.
+    """
+
+    MAX_IOV = 64
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.error = None
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, offset, block):
+        self._queue.put((offset, block))
+
+    def _run(self):
+        item = self._queue.get()
+        while item is not None:
+            # Agrupar los bloques contiguos ya encolados en un solo pwritev
+            offset, block = item
+            blocks = [block]
+            end = offset + len(block)
+            nxt = False
+            while len(blocks) < self.MAX_IOV:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    nxt = False
+                    break
+                if nxt is None or nxt[0] != end:
+                    break
+                blocks.append(nxt[1])
+                end += len(nxt[1])
+                nxt = False
+
+            if self.error is None:
+                try:
+                    self._pwritev_all(blocks, offset, end - offset)
+                except OSError as e:
+                    self.error = e
+
+            # nxt: elemento ya extraído que no se pudo agrupar (False si ninguno)
+            item = self._queue.get() if nxt is False else nxt
+
+    def _pwritev_all(self, blocks, offset, total):
+        """pwritev hasta completar total bytes; reintenta tras escrituras parciales."""
+        written = os.pwritev(self.fd, blocks, offset)
+        while written < total:
+            if written == 0:
+                raise OSError(f"pwritev no avanzó en offset {offset}")
+            # Descartar los bloques ya escritos y recortar el primero pendiente
+            while written >= len(blocks[0]):
+                written -= len(blocks[0])
+                offset += len(blocks[0])
+                total -= len(blocks[0])
+                blocks = blocks[1:]
+            blocks = [memoryview(blocks[0])[written:]] + blocks[1:]
+            offset += written
+            total -= written
+            written = os.pwritev(self.fd, blocks, offset)
+
+    def close(self):
+        """Esperar las escrituras pendientes; relanza el primer error."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 class UARTPhotoClient:
     def __init__(self, port, baudrate=57600, timeout=8, rtscts=False, xonxoff=False):
         self.port = port
@@ -45,23 +130,16 @@ class UARTPhotoClient:
         self.rtscts = rtscts
         self.xonxoff = xonxoff
         self.ser = None
+        self._fd = None
+        self._poller = None
         self.received_data = bytearray()
+        self._rx_buf = bytearray()      # Buffer de recepción reutilizado entre imágenes
+        self._rx_pending = bytearray()  # Bytes leídos tras un marcador, aún sin consumir
+        self._cmd_cache = {}            # resolución -> comando ya codificado
 
     def connect(self):
         """Conectar con configuración"""
         try:
-            # Preparación opcional del puerto
-            try:
-                subprocess.run([
-                    'stty', '-F', self.port,
-                    'speed', str(self.baudrate),
-                    'cs8', '-cstopb', '-parenb', 'raw', '-crtscts',
-                    '-echo', '-echoe', '-echok'
-                ], check=True, timeout=3)
-                time.sleep(0.2)
-            except Exception as e:
-                logging.debug(f"(stty opcional) {e}")
-
             self.ser = serial.Serial(
                 port=self.port,
                 baudrate=self.baudrate,
@@ -74,238 +152,431 @@ class UARTPhotoClient:
                 xonxoff=self.xonxoff
             )
 
-            # Limpieza inicial extendida
-            for _ in range(5):
-                self.ser.reset_input_buffer()
-                self.ser.reset_output_buffer()
-                time.sleep(0.1)
+            # Espera de datos por poll() sobre el fd crudo (ver _read); el fd debe
+            # ser O_NONBLOCK para que os.read nunca bloquee fuera del poll()
+            self._fd = self.ser.fileno()
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._poller = select.poll()
+            self._poller.register(self._fd, select.POLLIN)
+            self._set_low_latency()
+
+            # Limpieza inicial: un solo flush de ambas colas en el kernel
+            termios.tcflush(self._fd, termios.TCIOFLUSH)
+            termios.tcdrain(self._fd)
 
-            logging.info(f"✅ Cliente: {self.port} @ {self.baudrate} (rtscts={self.rtscts}, xonxoff={self.xonxoff})")
+            logging.info("✅ Cliente: %s @ %d (rtscts=%s, xonxoff=%s)", self.port, self.baudrate, self.rtscts, self.xonxoff)
             return True
 
         except Exception as e:
-            logging.error(f"❌ Error conexión: {e}")
+            logging.error("❌ Error conexión: %s", e)
             return False
 
+    def _set_low_latency(self):
+        """Activar ASYNC_LOW_LATENCY en el tty (o latency_timer=1 en adaptadores USB-serial)"""
+        try:
+            self.ser.set_low_latency_mode(True)
+            logging.debug("⚡ ASYNC_LOW_LATENCY activado")
+            return
+        except Exception as e:
+            logging.debug("(low_latency no soportado) %s", e)
+
+        tty = os.path.basename(os.path.realpath(self.port))
+        try:
+            with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as f:
+                f.write("1")
+            logging.debug("⚡ latency_timer=1 en %s", tty)
+        except OSError as e:
+            logging.debug("(latency_timer no disponible) %s", e)
+
     def send_command(self, resolution="THUMBNAIL"):
         """Enviar comando con limpieza previa"""
         try:
-            cmd = f"{CMD_BEGIN}{CMD_START}{{size_name:{resolution}}}{CMD_END}\r\n"
-            logging.info(f"📤 Enviando comando: {cmd.strip()}")
+            cmd = self._cmd_cache.get(resolution)
+            if cmd is None:
+                cmd = f"{CMD_BEGIN}{CMD_START}{{size_name:{resolution}}}{CMD_END}\r\n".encode('ascii')
+                self._cmd_cache[resolution] = cmd
+            logging.info("📤 Enviando comando: %s", cmd.decode('ascii').strip())
 
-            # Limpieza más agresiva
-            for _ in range(3):
-                self.ser.reset_input_buffer()
-                self.ser.reset_output_buffer()
-                time.sleep(0.1)
+            # Descartar basura previa en ambas colas (una sola llamada)
+            termios.tcflush(self._fd, termios.TCIOFLUSH)
+            self._rx_pending.clear()
 
-            self.ser.write(cmd.encode('utf-8'))
+            self.ser.write(cmd)
             self.ser.flush()
             logging.info("✅ Comando enviado")
-            time.sleep(1.0)
             return True
         except Exception as e:
-            logging.error(f"❌ Error enviando: {e}")
+            logging.error("❌ Error enviando: %s", e)
             return False
 
+    def _read_line(self, deadline):
+        """Leer una línea terminada en \\n del fd crudo antes del deadline.
+
+        Lo que llegue después del \\n vuelve a _rx_pending; retorna None si vence.
+        """
+        buf = bytearray()
+        while True:
+            idx = buf.find(b"\n")
+            if idx != -1:
+                self._rx_pending[:0] = buf[idx + 1:]
+                return bytes(buf[:idx + 1])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            buf += self._read(256, timeout=remaining)
+
     def wait_for_response(self, timeout_s=None):
         """Esperar respuesta con timeout extendido"""
         if timeout_s is None:
             timeout_s = TIMEOUT_RESP
-        end = time.time() + timeout_s
+        end = time.monotonic() + timeout_s
         
-        while time.time() < end:
+        # poll() bloquea hasta que llega cada línea; sin lecturas byte a byte
+        while time.monotonic() < end:
             try:
-                line = self.ser.readline().decode('utf-8', errors='ignore').strip()
+                raw = self._read_line(end)
+                if raw is None:
+                    break
+                line = raw.decode('utf-8', errors='ignore').strip()
                 if line and (line.startswith(RESP_OK) or line.startswith(RESP_BAD)):
-                    logging.info(f"✅ Respuesta: {line}")
+                    logging.info("✅ Respuesta: %s", line)
                     return line
+                if line == RESP_BUSY:
+                    # El servidor está capturando: el plazo cuenta desde este latido
+                    logging.info("⏳ Servidor capturando...")
+                    end = time.monotonic() + timeout_s
+            except serial.SerialException as e:
+                logging.error("❌ Error leyendo respuesta: %s", e)
+                return None
             except Exception as e:
-                logging.debug(f"Error leyendo respuesta: {e}")
+                logging.debug("Error leyendo respuesta: %s", e)
                 continue
                 
         logging.warning("⏱️ Timeout esperando respuesta")
         return None
 
+    def _write_control(self, msg):
+        """Escribir una línea de control directo al fd no bloqueante.
+
+        Las líneas de control caben en el buffer del driver, así que os.write
+        retorna de inmediato y la recepción puede volver a poll() sin esperar
+        el envío; solo si el kernel no aceptó todo se completa con ser.write.
+        """
+        try:
+            n = os.write(self._fd, msg)
+        except BlockingIOError:
+            n = 0
+        if n < len(msg):
+            self.ser.write(msg[n:])
+
     def send_client_ready(self):
         """Informar al servidor que estamos listos para recibir"""
         try:
-            msg = f"{ACK_READY}\r\n"
-            self.ser.write(msg.encode('utf-8'))
-            self.ser.flush()
+            self._write_control(ACK_READY)
             logging.info("📋 Informamos al servidor: cliente listo")
             return True
         except Exception as e:
-            logging.error(f"❌ Error enviando ready: {e}")
+            logging.error("❌ Error enviando ready: %s", e)
             return False
 
     def send_ack_status(self, received_bytes: int, expected_bytes: int):
         """Enviar estado ACK al servidor"""
         try:
             if received_bytes == expected_bytes:
-                msg = f"{ACK_OK}\r\n"
-                logging.info(f"✅ Enviando ACK_OK: {received_bytes} bytes recibidos correctamente")
+                msg = ACK_OK
+                logging.info("✅ Enviando ACK_OK: %d bytes recibidos correctamente", received_bytes)
             else:
-                msg = f"{ACK_MISSING}:{received_bytes}\r\n"
+                msg = ACK_MISSING % received_bytes
                 missing = expected_bytes - received_bytes
-                logging.warning(f"⚠️ Enviando ACK_MISSING: faltan {missing} bytes (recibido {received_bytes}/{expected_bytes})")
+                logging.warning("⚠️ Enviando ACK_MISSING: faltan %d bytes (recibido %d/%d)", missing, received_bytes, expected_bytes)
             
-            self.ser.write(msg.encode('utf-8'))
-            self.ser.flush()
+            self._write_control(msg)
             return True
         except Exception as e:
-            logging.error(f"❌ Error enviando ACK: {e}")
+            logging.error("❌ Error enviando ACK: %s", e)
             try:
-                self.ser.write(f"{ACK_ERROR}\r\n".encode('utf-8'))
-                self.ser.flush()
+                self._write_control(ACK_ERROR)
             except:
                 pass
             return False
 
-    def _wait_start_marker(self, max_wait=45):
-        """Esperar marcador de inicio con timeout extendido"""
+    def _read(self, nbytes, timeout=None):
+        """Leer hasta nbytes, consumiendo primero lo sobrante de la búsqueda de marcadores.
+
+        Bloquea en poll() hasta que llegan datos o vence el timeout y lee con
+        un único os.read() lo disponible; retorna b'' si no llegó nada.
+        """
+        if self._rx_pending:
+            data = bytes(self._rx_pending[:nbytes])
+            del self._rx_pending[:nbytes]
+            return data
+        if timeout is None:
+            timeout = self.timeout
+        if not self._poller.poll(max(0, int(timeout * 1000))):
+            return b''
+        try:
+            data = os.read(self._fd, nbytes)
+        except BlockingIOError:
+            return b''
+        if not data:
+            self._hangup()
+        return data
+
+    def _read_into(self, view, timeout=None):
+        """Como _read, pero escribiendo directamente en 'view' (memoryview) sin copias intermedias"""
+        if self._rx_pending:
+            n = min(len(view), len(self._rx_pending))
+            view[:n] = self._rx_pending[:n]
+            del self._rx_pending[:n]
+            return n
+        if timeout is None:
+            timeout = self.timeout
+        if not self._poller.poll(max(0, int(timeout * 1000))):
+            return 0
+        try:
+            n = os.readv(self._fd, [view])
+        except BlockingIOError:
+            return 0
+        if not n and len(view):
+            self._hangup()
+        return n
+
+    @staticmethod
+    def _hangup():
+        """poll() listo pero os.read sin datos: el puerto se cerró o desconectó.
+
+        Se distingue así de un timeout (b'') y se falla de inmediato, como pyserial.
+        """
+        raise serial.SerialException(
+            "device reports readiness to read but returned no data "
+            "(device disconnected or multiple access on port?)")
+
+    def _read_header(self, max_wait=60):
+        """Buscar START_MARKER y leer el tamaño de 4 bytes en un solo bucle.
+
+        Retorna el tamaño transmitido o None. Los bytes de datos que llegaron
+        junto con la cabecera quedan en _rx_pending para _read_exact.
+        """
         logging.info("🔍 Buscando marcador de inicio...")
-        deadline = time.time() + max_wait
+        deadline = time.monotonic() + max_wait
+        keep = len(START_MARKER) - 1
         window = bytearray()
+        found = False
 
-        while time.time() < deadline:
-            b = self.ser.read(1)
-            if not b:
+        while time.monotonic() < deadline:
+            chunk = self._read(4096, timeout=deadline - time.monotonic())
+            if not chunk:
                 continue
-                
-            window += b
-            if len(window) > len(START_MARKER):
-                window = window[-len(START_MARKER):]
-                
-            if window == START_MARKER:
+
+            window += chunk
+            if not found:
+                idx = window.find(START_MARKER)
+                if idx == -1:
+                    # Conservar solo la cola que podría contener un marcador partido
+                    del window[:-keep]
+                    continue
                 logging.info("✅ Marcador de inicio encontrado")
-                return True
-                
-            # Detectar marcador de retransmisión
-            if len(window) >= 4 and window[-4:] == b"\xCC" * 4:
+                del window[:idx + len(START_MARKER)]
+                found = True
+
+            if len(window) >= SIZE_BYTES:
+                self._rx_pending = window[SIZE_BYTES:]
+                return int.from_bytes(window[:SIZE_BYTES], 'big')
+
+        if found:
+            logging.error("❌ No se pudieron leer 4 bytes de tamaño")
+        else:
+            logging.error("❌ No se encontró marcador de inicio")
+        return None
+
+    def _wait_retry_marker(self, max_wait=60):
+        """Esperar RETRY_MARKER tras un ACK_MISSING.
+
+        Los bytes posteriores al marcador quedan en _rx_pending.
+        """
+        deadline = time.monotonic() + max_wait
+        keep = len(RETRY_MARKER) - 1
+        window = bytearray()
+
+        while time.monotonic() < deadline:
+            chunk = self._read(4096, timeout=deadline - time.monotonic())
+            if not chunk:
+                continue
+
+            window += chunk
+            idx = window.find(RETRY_MARKER)
+            if idx != -1:
+                self._rx_pending = window[idx + len(RETRY_MARKER):]
                 logging.info("🔄 Detectado marcador de retransmisión")
-                return "retry"
-                
-        logging.error("❌ No se encontró marcador de inicio")
+                return True
+            del window[:-keep]
+
+        logging.error("❌ No llegó la retransmisión")
         return False
 
-    def _read_exact(self, nbytes, inactivity_timeout=45, chunk_size=4096):
-        """Lectura exacta con manejo de retransmisiones"""
+    def _tail_in_data(self, received_bytes):
+        """True si la cola final (END_MARKER ... END_TEXT) quedó dentro de los datos.
+
+        Ocurre cuando se perdieron bytes a mitad del flujo: la cola se leyó
+        como carga útil y reenviar desde received_bytes no lo arreglaría.
+        """
+        end = self._rx_buf.rfind(END_TEXT, 0, received_bytes)
+        return end != -1 and self._rx_buf.rfind(END_MARKER, 0, end) != -1
+
+    def _read_exact(self, view, inactivity_timeout=45, chunk_size=65536, writer=None, file_offset=0):
+        """Lectura exacta sobre un buffer preasignado; retorna los bytes recibidos.
+
+        Los marcadores de retransmisión solo llegan después de un ACK_MISSING
+        y no pueden aparecer aquí; todo byte es dato. Si se indica
+        writer, cada bloque se encola para escribirse en file_offset + posición.
+        """
+        nbytes = len(view)
         remaining = nbytes
-        last_data_time = time.time()
+        deadline = time.monotonic() + inactivity_timeout
         got = 0
-        last_progress = 0
+        # Progreso cada 10%: umbral en bytes, sin divisiones por iteración
+        log_progress = nbytes >= 10000 and logging.getLogger().isEnabledFor(logging.INFO)
+        next_progress = nbytes // 10
 
         while remaining > 0:
-            # Detectar posible retransmisión mirando bytes disponibles
-            if self.ser.in_waiting >= 4:
-                # Leer 4 bytes para verificar si es marcador de retransmisión
-                potential_marker = self.ser.read(4)
-                if potential_marker == b"\xCC" * 4:
-                    logging.info("🔄 Retransmisión detectada durante lectura")
-                    continue
-                else:
-                    # No era marcador, agregar estos bytes a los datos
-                    self.received_data.extend(potential_marker)
-                    got += len(potential_marker)
-                    remaining -= len(potential_marker)
-                    last_data_time = time.time()
-
+            # os.readv devuelve todo lo que el kernel tenga acumulado hasta to_read,
+            # así que un bloque grande drena el buffer en una sola llamada; el
+            # timeout de poll() es el propio deadline de inactividad
             to_read = min(chunk_size, remaining)
-            chunk = self.ser.read(to_read)
+            n = self._read_into(view[got:got + to_read], timeout=deadline - time.monotonic())
             
-            if chunk:
-                self.received_data.extend(chunk)
-                got += len(chunk)
-                remaining -= len(chunk)
-                last_data_time = time.time()
+            if n:
+                if writer is not None:
+                    writer.submit(file_offset + got, view[got:got + n])
+                got += n
+                remaining -= n
+                deadline = time.monotonic() + inactivity_timeout
 
                 # Log de progreso mejorado
-                if nbytes >= 10000:
-                    progress = int((got / nbytes) * 100)
-                    if progress - last_progress >= 10:
-                        logging.info(f"📊 Progreso: {got}/{nbytes} bytes ({progress}%)")
-                        last_progress = progress
-            else:
-                # Verificar timeout por inactividad
-                if time.time() - last_data_time > inactivity_timeout:
-                    logging.error(f"❌ Timeout sin datos (recibido {got}/{nbytes})")
-                    return False
+                if log_progress and got >= next_progress:
+                    progress = got * 100 // nbytes
+                    logging.info("📊 Progreso: %d/%d bytes (%d%%)", got, nbytes, progress)
+                    next_progress = (progress // 10 + 1) * nbytes // 10
+            elif time.monotonic() >= deadline:
+                logging.error("❌ Timeout sin datos (recibido %d/%d)", got, nbytes)
+                return got
                     
-        return True
+        return got
 
     def receive_image(self, expected_size, save_path=None, enable_ack=True):
         """Recepción con protocolo ACK completo"""
+        received_bytes = 0
+        out_fd = None
+        writer = None
+        saved = False
         try:
             logging.info("📥 Iniciando recepción ...")
 
             # 1. Opcional: Informar que estamos listos
             if enable_ack:
                 self.send_client_ready()
-                time.sleep(0.5)
 
-            # 2. Esperar marcador de inicio
-            start_result = self._wait_start_marker(max_wait=60)
-            if start_result == False:
+            # 2-3. Marcador de inicio y tamaño transmitido en una sola lectura
+            transmitted_size = self._read_header(max_wait=60)
+            if transmitted_size is None:
                 return False
-            elif start_result == "retry":
-                logging.info("🔄 Iniciando desde retransmisión")
-
-            # 3. Leer tamaño transmitido
-            size_data = b''
-            size_deadline = time.time() + 15
-            while len(size_data) < SIZE_BYTES and time.time() < size_deadline:
-                chunk = self.ser.read(SIZE_BYTES - len(size_data))
-                if chunk:
-                    size_data += chunk
-
-            if len(size_data) != SIZE_BYTES:
-                logging.error("❌ No se pudieron leer 4 bytes de tamaño")
+
+            logging.info("📊 Tamaño transmitido: %d bytes", transmitted_size)
+            logging.info("📊 Tamaño esperado: %d bytes", expected_size)
+
+            # El tamaño viene del cable sin verificar: se valida contra el OK|size
+            # (o el tope si no se conoce) antes de reservar el buffer
+            if (expected_size and transmitted_size != expected_size) or transmitted_size > MAX_IMAGE_SIZE:
+                logging.error("❌ Cabecera inválida: tamaño transmitido %d, esperado %d", transmitted_size, expected_size)
                 if enable_ack:
-                    self.send_ack_status(0, expected_size)
+                    self._write_control(ACK_ERROR)
                 return False
 
-            transmitted_size = struct.unpack('>I', size_data)[0]
-            logging.info(f"📊 Tamaño transmitido: {transmitted_size} bytes")
-            logging.info(f"📊 Tamaño esperado: {expected_size} bytes")
-
-            # 4. Recepción principal
-            self.received_data = bytearray()
-            success = self._read_exact(transmitted_size, inactivity_timeout=60)
+            # 4. Recepción principal: buffer preasignado (sin realocaciones) y
+            #    escritura a disco en un hilo aparte mientras llega el siguiente
+            if not save_path:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                save_path = f"imagen{timestamp}.jpg"
+            # Se escribe en un .part y solo se renombra al guardar: un fallo
+            # nunca pisa ni borra un archivo previo con el mismo nombre
+            part_path = save_path + ".part"
+            out_fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            writer = _BlockWriter(out_fd)
+
+            # Buffer persistente: solo se realoca si llega una imagen mayor
+            if len(self._rx_buf) < transmitted_size:
+                self._rx_buf = bytearray(transmitted_size)
+            view = memoryview(self._rx_buf)[:transmitted_size]
+            self.received_data = view
+            received_bytes = self._read_exact(view, inactivity_timeout=60, writer=writer)
+
+            # 4b. Corrección: el servidor reenvía desde received_bytes y los
+            #     bytes completan el mismo buffer y archivo en su posición
+            corrections = 0
+            while enable_ack and received_bytes < transmitted_size:
+                # Cola final dentro de los datos: pérdida a mitad de flujo, no
+                # truncado; ACK_ERROR inmediato en lugar de pedir reenvío
+                if self._tail_in_data(received_bytes):
+                    logging.error("❌ Cola final dentro de los datos: bytes perdidos a mitad del flujo")
+                    self._write_control(ACK_ERROR)
+                    return False
+                if corrections >= MAX_CORRECTIONS:
+                    break
+                corrections += 1
+                logging.info("🔄 Ciclo de corrección #%d/%d", corrections, MAX_CORRECTIONS)
+                self.send_ack_status(received_bytes, transmitted_size)
+                if not self._wait_retry_marker(max_wait=60):
+                    break
+                received_bytes += self._read_exact(view[received_bytes:], inactivity_timeout=60,
+                                                   writer=writer, file_offset=received_bytes)
             
-            if not success:
+            if received_bytes < transmitted_size:
                 if enable_ack:
-                    self.send_ack_status(len(self.received_data), expected_size)
+                    self.send_ack_status(received_bytes, expected_size)
                 return False
 
-            received_bytes = len(self.received_data)
-            logging.info(f"✅ Recepción completada: {received_bytes} bytes")
+            logging.info("✅ Recepción completada: %d bytes", received_bytes)
 
-            # 5. Drenaje de cola final (marcadores)
+            # 5. Drenaje de cola final (marcadores) hasta END_TEXT o TAIL_TIMEOUT:
+            #    sin cola no hay CRC que verificar, y eso cuenta como fallo
+            crc_valid = True
             try:
-                original_timeout = self.ser.timeout
-                self.ser.timeout = 1.0  # Timeout más largo para marcadores
                 extra = bytearray()
-                
-                # Leer hasta encontrar marcadores finales o timeout
-                while True:
-                    chunk = self.ser.read(100)
-                    if not chunk:
-                        break
-                    extra.extend(chunk)
-                    
-                    # Buscar marcadores finales
-                    if b"<FIN_TRANSMISION>" in extra:
-                        logging.info("🏁 Marcadores finales detectados")
+                deadline = time.monotonic() + TAIL_TIMEOUT
+                while END_TEXT not in extra:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
                         break
-                
+                    extra += self._read(4096, timeout=remaining)
+
+                if END_TEXT in extra:
+                    logging.info("🏁 Marcadores finales detectados")
                 if extra:
-                    logging.info(f"🔚 Drenado: {len(extra)} bytes de cola final")
+                    logging.info("🔚 Drenado: %d bytes de cola final", len(extra))
+
+                # Cola esperada: END_MARKER + CRC32 + END_TEXT (servidores antiguos
+                # no envían el CRC); si no encaja, el flujo quedó desalineado
+                end = extra.find(END_TEXT)
+                if end == -1:
+                    logging.error("❌ No llegó la cola final (%s): CRC sin verificar", END_TEXT.decode())
+                    crc_valid = False
+                else:
+                    crc_at = end - SIZE_BYTES
+                    if crc_at >= len(END_MARKER) and extra[crc_at - len(END_MARKER):crc_at] == END_MARKER:
+                        crc_rx = int.from_bytes(extra[crc_at:end], "big")
+                        crc_calc = zlib.crc32(view)
+                        if crc_rx == crc_calc:
+                            logging.info("🔐 CRC32 correcto: %08x", crc_calc)
+                        else:
+                            logging.error("❌ CRC32 no coincide: recibido %08x, calculado %08x", crc_rx, crc_calc)
+                            crc_valid = False
+                    elif extra[max(0, end - len(END_MARKER)):end] != END_MARKER:
+                        logging.error("❌ Cola final desalineada: datos perdidos o de más")
+                        crc_valid = False
                     
             except Exception as e:
-                logging.debug(f"Error drenando cola: {e}")
-            finally:
-                self.ser.timeout = original_timeout
+                logging.error("❌ Error drenando cola: %s", e)
+                crc_valid = False
 
             # 6. Validación JPEG
             jpeg_valid = True
@@ -318,22 +589,25 @@ class UARTPhotoClient:
 
             # 7. Envío de ACK final
             if enable_ack:
-                # Pausa para asegurar que el servidor esté esperando ACK
-                time.sleep(1.0)
-                self.send_ack_status(received_bytes, expected_size)
-
-            # 8. Guardar archivo
-            if not save_path:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                save_path = f"imagen{timestamp}.jpg"
-
-            with open(save_path, 'wb') as f:
-                f.write(self.received_data)
-
-            logging.info(f"💾 Imagen guardada: {save_path}")
+                # El ACK queda en la cola del tty hasta que el servidor lo lea
+                if crc_valid:
+                    self.send_ack_status(received_bytes, expected_size)
+                else:
+                    self._write_control(ACK_ERROR)
+
+            # 8. Esperar las escrituras a disco que sigan en curso
+            writer.close()
+            writer = None
+            if not crc_valid:
+                # Imagen corrupta: no pisar el archivo de salida; finally borra el .part
+                logging.error("❌ Imagen descartada (CRC/cola inválida): %s", save_path)
+                return False
+            os.replace(part_path, save_path)
+            saved = True
+            logging.info("💾 Imagen guardada: %s", save_path)
             
             # Resultado final
-            success_final = received_bytes == expected_size and jpeg_valid
+            success_final = received_bytes == expected_size and jpeg_valid and crc_valid
             if success_final:
                 logging.info("🎉 RECEPCIÓN EXITOSA")
             else:
@@ -342,13 +616,26 @@ class UARTPhotoClient:
             return success_final
 
         except Exception as e:
-            logging.error(f"❌ Error en recepción: {e}")
+            logging.error("❌ Error en recepción: %s", e)
             if enable_ack:
                 try:
-                    self.send_ack_status(len(self.received_data) if hasattr(self, 'received_data') else 0, expected_size)
+                    self.send_ack_status(received_bytes, expected_size)
                 except:
                     pass
             return False
+        finally:
+            if writer is not None:
+                try:
+                    writer.close()
+                except OSError:
+                    pass
+            if out_fd is not None:
+                os.close(out_fd)
+                if not saved:
+                    try:
+                        os.unlink(part_path)
+                    except OSError:
+                        pass
 
     def close(self):
         """Cierre"""
@@ -359,7 +646,7 @@ class UARTPhotoClient:
                 self.ser.close()
                 logging.info("🔌 Cliente cerrado")
         except Exception as e:
-            logging.debug(f"Error cerrando cliente: {e}")
+            logging.debug("Error cerrando cliente: %s", e)
 
 def main():
     parser = argparse.ArgumentParser(description='Cliente UART con protocolo ACK')
@@ -404,13 +691,13 @@ def main():
             logging.error("❌ No se recibió respuesta del servidor")
             return
         if not response.startswith(RESP_OK):
-            logging.error(f"❌ Error del servidor: {response}")
+            logging.error("❌ Error del servidor: %s", response)
             return
 
         # Extraer tamaño esperado
         try:
             expected_size = int(response.split("|")[1])
-            logging.info(f"📊 Tamaño esperado según servidor: {expected_size} bytes")
+            logging.info("📊 Tamaño esperado según servidor: %d bytes", expected_size)
         except Exception:
             logging.warning("⚠️ No se pudo parsear tamaño de respuesta")
             expected_size = 0
@@ -430,7 +717,7 @@ def main():
     except KeyboardInterrupt:
         logging.info("\n🛑 Cliente detenido por usuario")
     except Exception as e:
-        logging.error(f"❌ Error crítico: {e}")
+        logging.error("❌ Error crítico: %s", e)
     finally:
         client.close()
 
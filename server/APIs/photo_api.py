@@ -3,12 +3,14 @@
 """
 photo_api.py — API de captura
 - Captura con rpicam-still (opcional)
+- Modo stream: rpicam-vid MJPEG persistente, cámara siempre caliente
 - Soporta fallback desde archivo
 - Retorna bytes o guarda a archivo
 """
 
 import os
 import subprocess
+import threading
 import logging
 
 RESOLUTIONS = {
@@ -36,6 +38,169 @@ def _capture_with_rpicam(size_name: str, timeout_s: int = 8) -> bytes | None:
         logging.warning(f"⚠️ rpicam-still error: {e}")
         return None
 
+class _MjpegStream:
+    """rpicam-vid --codec mjpeg persistente; un hilo separa los cuadros JPEG.
+
+    Evita lanzar un proceso y reconverger la exposición en cada captura.
+    """
+
+    SOI = b"\xff\xd8"
+    MAX_FRAME = 16 * 1024 * 1024  # Tope del buffer: un cuadro mayor se descarta
+
+    def __init__(self, width: int, height: int):
+        self.size = (width, height)
+        cmd = ["rpicam-vid", "-n", "-t", "0", "--codec", "mjpeg",
+               "--width", str(width), "--height", str(height), "-o", "-"]
+        logging.info(f"🎥 rpicam-vid MJPEG {width}x{height} (stream persistente)")
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        self.frame: bytes | None = None
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    @staticmethod
+    def _parse(buf: bytearray, pos: int, in_scan: bool):
+        """Avanzar por los segmentos de un cuadro abierto a partir de pos.
+
+        Los segmentos con longitud (APPn con miniatura EXIF, COM, DQT...) se
+        saltan enteros, así que un FF D8/FF D9 en su contenido no cuenta. En los
+        datos de entropía FF 00 y FF D0-D7 no son marcadores.
+        Retorna (pos, in_scan, fin): fin es el índice tras EOI, None si faltan
+        bytes o -1 si el flujo no es un JPEG válido.
+        """
+        n = len(buf)
+        while True:
+            if in_scan:
+                i = buf.find(b"\xff", pos)
+                if i < 0 or i + 1 >= n:
+                    return (pos if i < 0 else i), True, None
+                m = buf[i + 1]
+                if m == 0x00 or 0xD0 <= m <= 0xD7:
+                    pos = i + 2
+                    continue
+                if m == 0xFF:
+                    pos = i + 1
+                    continue
+                pos, in_scan = i, False
+            if pos + 1 >= n:
+                return pos, False, None
+            if buf[pos] != 0xFF:
+                return pos, False, -1
+            m = buf[pos + 1]
+            if m == 0xFF:
+                pos += 1  # relleno entre marcadores
+            elif m == 0xD9:
+                return pos + 2, False, pos + 2
+            elif 0xD0 <= m <= 0xD7 or m == 0x01:
+                pos += 2
+            elif m == 0xD8:
+                return pos, False, -1
+            else:
+                if pos + 3 >= n:
+                    return pos, False, None
+                length = (buf[pos + 2] << 8) | buf[pos + 3]
+                if length < 2:
+                    return pos, False, -1
+                if pos + 2 + length > n:
+                    return pos, False, None
+                pos += 2 + length
+                in_scan = m == 0xDA  # tras SOS vienen datos de entropía
+
+    def _run(self):
+        buf = bytearray()
+        pos = -1  # -1: buscando SOI; si no, posición de parseo del cuadro en buf[0:]
+        in_scan = False
+        while True:
+            chunk = self.proc.stdout.read(65536)
+            if not chunk:
+                break
+            buf += chunk
+            while True:
+                if pos < 0:
+                    soi = buf.find(self.SOI)
+                    if soi < 0:
+                        del buf[:-1]
+                        break
+                    del buf[:soi]
+                    pos, in_scan = 2, False
+                pos, in_scan, end = self._parse(buf, pos, in_scan)
+                if end is None:
+                    if len(buf) > self.MAX_FRAME:
+                        logging.warning("⚠️ rpicam-vid: cuadro demasiado grande, descartado")
+                        del buf[:2]
+                        pos = -1
+                        continue
+                    break
+                if end < 0:
+                    # Basura o cuadro truncado: resincronizar en el siguiente SOI
+                    del buf[:2]
+                    pos = -1
+                    continue
+                with self.cond:
+                    self.frame = bytes(buf[:end])
+                    self.seq += 1
+                    self.cond.notify_all()
+                del buf[:end]
+                pos = -1
+        with self.cond:
+            self.cond.notify_all()
+
+    def next_frame(self, timeout_s: float) -> bytes | None:
+        """Esperar un cuadro posterior a la llamada (no uno ya viejo)"""
+        with self.cond:
+            seq = self.seq
+            if self.cond.wait_for(lambda: self.seq > seq or not self.alive(), timeout_s) and self.seq > seq:
+                return self.frame
+        logging.warning("⚠️ rpicam-vid: sin cuadro nuevo")
+        return None
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+_stream: _MjpegStream | None = None
+_stream_lock = threading.Lock()
+
+def _capture_from_stream(size_name: str, timeout_s: int = 8) -> bytes | None:
+    global _stream
+    w, h = RESOLUTIONS.get(size_name.upper(), RESOLUTIONS["THUMBNAIL"])
+    with _stream_lock:
+        # Relanzar solo si cambió la resolución o el proceso murió
+        if _stream is not None and (_stream.size != (w, h) or not _stream.alive()):
+            _stream.stop()
+            _stream = None
+        if _stream is None:
+            try:
+                _stream = _MjpegStream(w, h)
+            except Exception as e:
+                logging.warning(f"⚠️ rpicam-vid error: {e}")
+                return None
+        stream = _stream
+    frame = stream.next_frame(timeout_s)
+    if frame is None:
+        # Sin cuadro a tiempo: relanzar en la próxima captura en vez de
+        # seguir esperando a un parser o proceso atascado
+        with _stream_lock:
+            if _stream is stream:
+                _stream.stop()
+                _stream = None
+    return frame
+
+def stop_stream():
+    """Detener el stream persistente de la cámara (si está activo)"""
+    global _stream
+    with _stream_lock:
+        if _stream is not None:
+            _stream.stop()
+            _stream = None
+
 def _load_fallback(fallback_image: str | None) -> bytes | None:
     if fallback_image and os.path.isfile(fallback_image):
         with open(fallback_image, "rb") as f:
@@ -45,13 +210,18 @@ def _load_fallback(fallback_image: str | None) -> bytes | None:
 def capture_photo(size_name: str = "THUMBNAIL",
                   use_camera: bool = True,
                   fallback_image: str | None = None,
-                  timeout_s: int = 8) -> bytes | None:
+                  timeout_s: int = 8,
+                  use_stream: bool = False) -> bytes | None:
     """
     Devuelve bytes JPEG o None si falla todo.
+    Con use_stream=True toma el próximo cuadro del rpicam-vid persistente.
     """
     data = None
     if use_camera:
-        data = _capture_with_rpicam(size_name, timeout_s)
+        if use_stream:
+            data = _capture_from_stream(size_name, timeout_s)
+        else:
+            data = _capture_with_rpicam(size_name, timeout_s)
     if data is None:
         data = _load_fallback(fallback_image)
     if data is None:
@@ -62,14 +232,15 @@ def capture_to_file(out_path: str,
                     size_name: str = "THUMBNAIL",
                     use_camera: bool = True,
                     fallback_image: str | None = None,
-                    timeout_s: int = 8) -> bool:
+                    timeout_s: int = 8,
+                    use_stream: bool = False) -> int:
     """
-    Guarda JPEG en 'out_path'. Retorna True/False.
+    Guarda JPEG en 'out_path'. Retorna los bytes escritos (0 si falla).
     """
-    data = capture_photo(size_name, use_camera, fallback_image, timeout_s)
+    data = capture_photo(size_name, use_camera, fallback_image, timeout_s, use_stream)
     if not data:
-        return False
+        return 0
     with open(out_path, "wb") as f:
         f.write(data)
     logging.info(f"💾 Imagen guardada en {out_path} ({len(data)} bytes)")
-    return True
+    return len(data)
@@ -9,22 +9,33 @@ transport_api.py — API de transporte UART unificada
 - Sin marcadores finales por defecto (evita corrupción)
 """
 
+import os
+import re
+import mmap
 import time
-import struct
+import select
+import termios
+import fcntl
+import threading
+import zlib
 import logging
 import serial
 
 START_MARKER = b"\xAA" * 10
 END_MARKER   = b"\xBB" * 10
 END_TEXT     = b"<FIN_TRANSMISION>\r\n"
+RETRY_MARKER = b"\xCC" * 4
 SIZE_BYTES   = 4
-DEFAULT_CHUNK = 512
+DEFAULT_CHUNK = 4096  # Tamaño típico del buffer de escritura del tty
 
 # Protocolo ACK mejorado
 ACK_READY = "ACK_READY"
 ACK_OK = "ACK_OK"
 ACK_MISSING = "ACK_MISSING:"
 ACK_ERROR = "ACK_ERROR"
+# ACK_OK / ACK_ERROR / ACK_MISSING:<recibidos> sobre la línea cruda (sin decode/strip)
+_ACK_READY = ACK_READY.encode()
+_ACK_RE = re.compile(rb"^\s*ACK_(OK|ERROR|MISSING)(?::+(\d+)?)?\s*$")
 
 class UartTransport:
     def __init__(self, port: str, baudrate: int = 57600, timeout: float = 2.0,
@@ -35,6 +46,16 @@ class UartTransport:
         self.rtscts = rtscts
         self.xonxoff = xonxoff
         self.ser: serial.Serial | None = None
+        self._fd: int | None = None
+        self._poll_out = None
+        self._poll_in = None
+        self._rxbuf = bytearray()  # Bytes recibidos aún sin formar una línea completa
+        # Cabecera reutilizable: START_MARKER + tamaño (solo se reescriben los 4 bytes finales)
+        self._hdr = bytearray(START_MARKER + bytes(SIZE_BYTES))
+        # Cola reutilizable: END_MARKER + CRC32 del payload + END_TEXT
+        self._tail = bytearray(END_MARKER + bytes(SIZE_BYTES) + END_TEXT)
+        # Chunk por defecto: ~20 ms de línea, nunca menor que DEFAULT_CHUNK
+        self.default_chunk = max(DEFAULT_CHUNK, baudrate // (8 * 50))
 
     def connect(self) -> bool:
         try:
@@ -50,160 +71,249 @@ class UartTransport:
                 xonxoff=self.xonxoff
             )
             
-            # Limpieza inicial mejorada
-            for _ in range(5):
-                self.ser.reset_input_buffer()
-                self.ser.reset_output_buffer()
-                time.sleep(0.1)
+            # Escritura directa con os.write en el envío; el fd debe ser O_NONBLOCK
+            # para que un buffer lleno devuelva EAGAIN en lugar de bloquear
+            self._fd = self.ser.fileno()
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._poll_out = select.poll()
+            self._poll_out.register(self._fd, select.POLLOUT)
+            self._poll_in = select.poll()
+            self._poll_in.register(self._fd, select.POLLIN)
+
+            # Limpieza inicial: un solo flush de ambas colas en el kernel
+            termios.tcflush(self._fd, termios.TCIOFLUSH)
+            termios.tcdrain(self._fd)
             
-            logging.info(f"✅ UART Robusta: {self.port} @ {self.baudrate} (rtscts={self.rtscts}, xonxoff={self.xonxoff})")
+            self._set_low_latency()
+            logging.info("✅ UART Robusta: %s @ %d (rtscts=%s, xonxoff=%s)", self.port, self.baudrate, self.rtscts, self.xonxoff)
             return True
         except Exception as e:
-            logging.error(f"❌ UART open: {e}")
+            logging.error("❌ UART open: %s", e)
             return False
 
+    def _set_low_latency(self):
+        """Activar ASYNC_LOW_LATENCY en el tty (o latency_timer=1 en adaptadores USB-serial)"""
+        try:
+            self.ser.set_low_latency_mode(True)
+            logging.debug("⚡ ASYNC_LOW_LATENCY activado")
+            return
+        except Exception as e:
+            logging.debug("(low_latency no soportado) %s", e)
+
+        tty = os.path.basename(os.path.realpath(self.port))
+        try:
+            with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as f:
+                f.write("1")
+            logging.debug("⚡ latency_timer=1 en %s", tty)
+        except OSError as e:
+            logging.debug("(latency_timer no disponible) %s", e)
+
     def close(self):
         try:
             if self.ser and self.ser.is_open:
-                # Cierre más suave
-                self.ser.flush()
-                timeout_start = time.time()
-                while self.ser.out_waiting > 0 and (time.time() - timeout_start) < 10:
-                    time.sleep(0.1)
+                # Cierre más suave: esperar en el kernel a que salga lo pendiente
+                self._drain(timeout=10)
                 
                 self.ser.reset_output_buffer()
                 self.ser.reset_input_buffer()
                 self.ser.close()
                 logging.info("🔌 UART robusta cerrada")
         except Exception as e:
-            logging.debug(f"Error cerrando UART: {e}")
+            logging.debug("Error cerrando UART: %s", e)
 
     def _wait_for_client_ready(self, timeout: float = 30) -> bool:
         """Esperar que el cliente confirme estar listo para recibir"""
         logging.info("📋 Esperando que cliente esté listo...")
-        deadline = time.time() + timeout
+        deadline = time.monotonic() + timeout
         
-        while time.time() < deadline:
+        while True:
             try:
-                line = self.ser.readline().decode("utf-8", errors="ignore").strip()
-                if line == ACK_READY:
+                raw = self._read_line(deadline)
+                if raw is None:
+                    break
+                line = raw.strip()
+                if line == _ACK_READY:
                     logging.info("✅ Cliente listo para recibir")
                     return True
                 elif line:
-                    logging.debug(f"📨 Cliente (esperando ready): {line}")
+                    logging.debug("📨 Cliente (esperando ready): %s", line.decode("utf-8", errors="ignore"))
             except Exception as e:
-                logging.debug(f"Error leyendo ready: {e}")
-                
-            time.sleep(0.1)
+                logging.debug("Error leyendo ready: %s", e)
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(0.1)
         
         logging.warning("⏰ Timeout esperando cliente listo")
         return False
 
+    def read_line(self, timeout: float | None = None) -> bytes | None:
+        """Leer una línea de comando (bytes con \\n); None si no llega en timeout.
+
+        Comparte el buffer con la espera de ACKs, así un comando que llega
+        pegado al ACK anterior no se pierde.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return self._read_line(time.monotonic() + timeout)
+
+    def _read_line(self, deadline: float) -> bytes | None:
+        """Siguiente línea (con \\n) del fd crudo; None si vence el deadline (monotonic).
+
+        Bloquea en poll() hasta que llegan datos y lee en bloque con os.read;
+        lo que sobra tras el \\n queda en _rxbuf para la próxima línea.
+        """
+        while True:
+            idx = self._rxbuf.find(b"\n")
+            if idx != -1:
+                line = bytes(self._rxbuf[:idx + 1])
+                del self._rxbuf[:idx + 1]
+                return line
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if self._poll_in.poll(remaining * 1000):
+                try:
+                    chunk = os.read(self._fd, 256)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    # poll() listo pero sin datos: el otro extremo colgó (igual que pyserial)
+                    raise serial.SerialException(
+                        "device reports readiness to read but returned no data "
+                        "(device disconnected or multiple access on port?)")
+                self._rxbuf += chunk
+
     def _wait_for_ack(self, expected_size: int, timeout: float = 45) -> tuple[bool, int]:
         """Esperar ACK del cliente con timeout extendido"""
         logging.info("📋 Esperando confirmación final del cliente...")
-        deadline = time.time() + timeout
+        deadline = time.monotonic() + timeout
         
-        while time.time() < deadline:
+        while True:
             try:
-                line = self.ser.readline().decode("utf-8", errors="ignore").strip()
-                if not line:
+                raw = self._read_line(deadline)
+                if raw is None:
+                    break
+                m = _ACK_RE.match(raw)
+                if not m:
                     continue
                     
-                logging.info(f"📨 Cliente: {line}")
+                logging.info("📨 Cliente: %s", raw.strip().decode("ascii", errors="ignore"))
                 
-                if line == ACK_OK:
+                kind = m.group(1)
+                if kind == b"OK":
                     logging.info("✅ ACK_OK - Cliente confirmó recepción completa")
                     return True, 0
-                elif line.startswith(ACK_MISSING):
-                    try:
-                        # Mejorar parsing de ACK_MISSING - manejar formato ACK_MISSING:123 o ACK_MISSING::0
-                        parts = line.split(":")
-                        if len(parts) >= 2:
-                            # Obtener el último elemento que no sea vacío
-                            received_str = [p for p in parts[1:] if p.strip()]
-                            if received_str:
-                                received = int(received_str[-1])
-                                missing = expected_size - received
-                                logging.warning(f"⚠️ Faltan {missing} bytes (cliente recibió {received})")
-                                return False, missing
-                        
-                        # Si no se puede parsear, asumir que faltan todos los bytes
-                        logging.warning(f"⚠️ Formato ACK_MISSING no estándar, asumiendo 0 bytes recibidos")
-                        return False, expected_size
-                    except Exception as e:
-                        logging.error(f"❌ Error parseando ACK_MISSING '{line}': {e}")
-                        return False, expected_size
-                elif line == ACK_ERROR:
-                    logging.error("❌ Cliente reportó error")
+                elif kind == b"MISSING":
+                    # Acepta ACK_MISSING:123 y el formato antiguo ACK_MISSING::0
+                    if m.group(2):
+                        received = int(m.group(2))
+                        missing = expected_size - received
+                        logging.warning("⚠️ Faltan %d bytes (cliente recibió %d)", missing, received)
+                        return False, missing
+                    
+                    # Si no se puede parsear, asumir que faltan todos los bytes
+                    logging.warning("⚠️ Formato ACK_MISSING no estándar, asumiendo 0 bytes recibidos")
                     return False, expected_size
+                else:
+                    # Error del cliente (p.ej. CRC no coincide): no se reintenta
+                    logging.error("❌ Cliente reportó error")
+                    return False, 0
                     
             except Exception as e:
-                logging.debug(f"Error leyendo ACK: {e}")
-                
-            time.sleep(0.1)
+                logging.debug("Error leyendo ACK: %s", e)
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(0.1)
         
         logging.warning("⏰ Timeout esperando ACK final")
         return False, 0
 
-    def _send_missing_bytes(self, data: bytes, start_offset: int, missing_count: int) -> bool:
-        """Retransmitir bytes faltantes de manera robusta"""
+    def _send_missing_bytes(self, data: bytes, start_offset: int, missing_count: int,
+                            chunk_size: int | None = None) -> bool:
+        """Retransmitir bytes faltantes al mismo ritmo que el envío principal"""
         if start_offset >= len(data) or missing_count <= 0:
-            logging.error(f"❌ Parámetros retransmisión inválidos: offset={start_offset}, missing={missing_count}")
+            logging.error("❌ Parámetros retransmisión inválidos: offset=%d, missing=%d", start_offset, missing_count)
             return False
+
+        if chunk_size is None:
+            chunk_size = self.default_chunk
             
         end_offset = min(start_offset + missing_count, len(data))
-        missing_data = data[start_offset:end_offset]
+        total = end_offset - start_offset
+        view = memoryview(data)
         
-        logging.info(f"🔄 Retransmitiendo {len(missing_data)} bytes desde offset {start_offset}")
+        logging.info("🔄 Retransmitiendo %d bytes desde offset %d", total, start_offset)
         
         try:
-            # Marcador especial para retransmisión
-            retry_marker = b"\xCC" * 4
-            self.ser.write(retry_marker)
-            self.ser.flush()
-            time.sleep(0.1)  # Pausa para que cliente detecte retransmisión
-            
-            # Envío con chunks más pequeños y pausas
-            chunk_size = 64  # Chunks muy pequeños para máxima confiabilidad
-            sent = 0
+            # Marcador especial de retransmisión junto con el primer chunk, en una
+            # sola escritura; el cliente lo busca en el flujo
+            pos = start_offset + min(chunk_size, total)
+            self._write(RETRY_MARKER + view[start_offset:pos])
             
-            while sent < len(missing_data):
-                chunk_end = min(sent + chunk_size, len(missing_data))
-                chunk = missing_data[sent:chunk_end]
-                
-                bytes_written = self.ser.write(chunk)
-                self.ser.flush()
-                sent += bytes_written
-                
-                # Pausa más larga para estabilidad
-                time.sleep(0.02)
-                
-                if sent % 256 == 0 or sent == len(missing_data):
-                    logging.info(f"🔄 Retransmisión: {sent}/{len(missing_data)} bytes")
+            # Resto por offsets sobre el buffer original (sin copias); la cola
+            # de TX del kernel marca el ritmo y se drena una sola vez al final
+            while pos < end_offset:
+                n = min(chunk_size, end_offset - pos)
+                pos += self._write(view[pos:pos + n])
+            logging.info("🔄 Retransmisión: %d/%d bytes", pos - start_offset, total)
+
+            # Cola con el CRC32 (ya calculado en el envío principal) para que el
+            # cliente verifique también el archivo corregido
+            self._write(self._tail)
             
-            # Pausa final después de retransmisión
-            time.sleep(0.5)
+            if not self._drain(timeout=15):
+                logging.error("❌ TIMEOUT drenando retransmisión")
+                return False
             logging.info("✅ Retransmisión completada")
             return True
             
         except Exception as e:
-            logging.error(f"❌ Error en retransmisión: {e}")
+            logging.error("❌ Error en retransmisión: %s", e)
             return False
 
-    def _calculate_smart_sleep(self, sent_bytes: int, total_bytes: int, base_sleep_ms: int) -> float:
-        """Calcular pausa inteligente - SIN desaceleración artificial problemática"""
-        base_sleep = max(0.001, base_sleep_ms / 1000.0)
-        
-        # Velocidad constante - eliminamos la desaceleración que causaba los chunks de 110ms
-        return base_sleep
-        
-        # NOTA: Comentamos la lógica de desaceleración que causaba el problema:
-        # if remaining_bytes <= 256: return base_sleep * 25  # ESTO causaba 125ms
-        # if remaining_bytes <= 512: return base_sleep * 20  # ESTO causaba 100ms
+    def _write(self, buf) -> int:
+        """os.write directo al fd; con el buffer lleno espera POLLOUT.
+
+        write_timeout cuenta desde el último avance (no desde el inicio), así un
+        buffer grande puede escribirse en una sola llamada sin vencer el plazo.
+        """
+        view = memoryview(buf)
+        total = len(view)
+        written = 0
+        deadline = time.monotonic() + self.ser.write_timeout
+        while written < total:
+            try:
+                written += os.write(self._fd, view[written:])
+                deadline = time.monotonic() + self.ser.write_timeout
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise serial.SerialTimeoutException("Write timeout")
+                self._poll_out.poll(remaining * 1000)
+        return written
+
+    def _drain(self, timeout: float = 15) -> bool:
+        """Esperar en el kernel (tcdrain) a que salga todo lo encolado.
+
+        Si vence el timeout (p.ej. CTS retenido) un temporizador descarta la
+        cola de TX, lo que libera tcdrain; en ese caso retorna False.
+        """
+        expired = threading.Event()
+
+        def _expire():
+            expired.set()
+            termios.tcflush(self._fd, termios.TCOFLUSH)
+
+        timer = threading.Timer(timeout, _expire)
+        timer.start()
+        try:
+            termios.tcdrain(self._fd)
+        finally:
+            timer.cancel()
+        return not expired.is_set()
 
     def send_bytes_robust(self, data: bytes,
-                         chunk_size: int = DEFAULT_CHUNK,
+                         chunk_size: int | None = None,
                          inter_chunk_sleep_ms: int = 0,
                          max_retries: int = 2,
                          wait_client_ready: bool = True) -> bool:
@@ -212,8 +322,11 @@ class UartTransport:
             logging.error("❌ UART no abierta")
             return False
 
+        if chunk_size is None:
+            chunk_size = self.default_chunk
+
         size = len(data)
-        logging.info(f"📊 Envío ROBUSTO: {size} bytes con protocolo ACK mejorado")
+        logging.info("📊 Envío ROBUSTO: %d bytes con protocolo ACK mejorado", size)
 
         try:
             # 0. Opcional: Esperar que cliente esté listo
@@ -221,23 +334,26 @@ class UartTransport:
                 if not self._wait_for_client_ready(timeout=30):
                     logging.warning("⚠️ Cliente no confirmó estar listo, continuando...")
 
-            # 1. Preámbulo del protocolo
+            # 1. Preámbulo del protocolo: marcador + tamaño + primer chunk seguidos;
+            #    el kernel serializa los bytes en orden
             logging.info("📤 Enviando preámbulo...")
-            self.ser.write(START_MARKER)
-            self.ser.flush()
-            time.sleep(0.1)  # Pausa fija, no variable
-            
-            size_bytes = struct.pack(">I", size)
-            self.ser.write(size_bytes)
-            self.ser.flush()
-            time.sleep(0.1)  # Pausa fija, no variable
+            view = memoryview(data)
+            sent = min(chunk_size, size)
+            self._hdr[len(START_MARKER):] = size.to_bytes(SIZE_BYTES, "big")
+            self._write(self._hdr)
+            self._write(view[:sent])
             
             # 2. Envío principal con velocidad CONSTANTE (sin desaceleración)
             logging.info("📦 Iniciando envío principal...")
-            sent = 0
-            view = memoryview(data)
-            last_log = 0
-            base_sleep = self._calculate_smart_sleep(0, size, inter_chunk_sleep_ms)
+            log_step = max(size // 10, 4096)
+            next_log_at = log_step
+            log_progress = logging.getLogger().isEnabledFor(logging.INFO)
+            base_sleep = max(0.0, inter_chunk_sleep_ms / 1000.0)
+            if base_sleep == 0:
+                # Sin pausas: escrituras grandes (un tramo de progreso cada una);
+                # _write espera POLLOUT cuando el buffer del driver se llena, así
+                # el driver y el control de flujo marcan el ritmo
+                chunk_size = max(chunk_size, log_step)
             
             while sent < size:
                 remaining = size - sent
@@ -246,66 +362,46 @@ class UartTransport:
                 
                 # Envío del chunk
                 try:
-                    bytes_written = self.ser.write(chunk)
+                    bytes_written = self._write(chunk)
                     if bytes_written != len(chunk):
-                        logging.warning(f"⚠️ Escritura parcial: {bytes_written}/{len(chunk)}")
+                        logging.warning("⚠️ Escritura parcial: %d/%d", bytes_written, len(chunk))
                     
-                    self.ser.flush()
                     sent += bytes_written
                     
                 except serial.SerialTimeoutException:
-                    logging.error(f"❌ Timeout escribiendo en byte {sent}")
+                    logging.error("❌ Timeout escribiendo en byte %d", sent)
                     return False
                 
-                # Pausa CONSTANTE (eliminamos la lógica de desaceleración)
+                # Pausa explícita del llamador
                 if base_sleep > 0:
                     time.sleep(base_sleep)
                 
                 # Log de progreso
-                pct = int(sent * 100 / size) if size else 100
-                if pct - last_log >= 10:
-                    logging.info(f"📦 Progreso constante: {sent}/{size} bytes ({pct}%)")
-                    last_log = pct
+                if log_progress and sent >= next_log_at:
+                    logging.info("📦 Progreso constante: %d/%d bytes (%d%%)", sent, size, sent * 100 // size)
+                    next_log_at = sent - sent % log_step + log_step
             
-            # 3. Sincronización final robusta
+            # 3. Marcadores finales a continuación de los datos (no cuentan en el tamaño),
+            #    con el CRC32 del payload entre ambos para que el cliente lo verifique
+            self._tail[len(END_MARKER):len(END_MARKER) + SIZE_BYTES] = zlib.crc32(data).to_bytes(SIZE_BYTES, "big")
+            self._write(self._tail)
+
+            # 4. Sincronización final robusta: un único drenaje cubre datos y marcadores
             logging.info("🔍 Sincronización final robusta...")
-            self.ser.flush()
-            
-            # Drenaje con timeout extendido
-            drain_start = time.time()
-            max_drain_time = 15
-            
-            while self.ser.out_waiting > 0:
-                if time.time() - drain_start > max_drain_time:
-                    logging.error(f"❌ TIMEOUT drenaje: {self.ser.out_waiting} bytes pendientes")
-                    return False
-                time.sleep(0.1)
-                
-                elapsed = time.time() - drain_start
-                if int(elapsed) % 3 == 0 and elapsed > 1:
-                    logging.info(f"⏳ Drenando: {self.ser.out_waiting} bytes ({elapsed:.1f}s)")
-            
-            # 4. Pausa de estabilización antes de marcadores
-            logging.info("⏳ Pausa de estabilización...")
-            time.sleep(1.0)  # Tiempo fijo para que cliente procese
-            
-            # 5. Marcadores finales
-            self.ser.write(END_MARKER)
-            self.ser.flush()
-            time.sleep(0.2)
-            self.ser.write(END_TEXT)
-            self.ser.flush()
-            time.sleep(0.2)
+            if not self._drain(timeout=15):
+                logging.error("❌ TIMEOUT drenaje: cola de TX descartada")
+                return False
             
             logging.info("📤 Envío completado, iniciando verificación ACK...")
             
-            # 6. Ciclo de verificación y corrección
+            # 5. Ciclo de verificación y corrección
             for retry in range(max_retries + 1):
                 if retry > 0:
-                    logging.info(f"🔄 Intento de corrección #{retry}/{max_retries}")
+                    logging.info("🔄 Intento de corrección #%d/%d", retry, max_retries)
                 
-                # Esperar ACK con timeout extendido
-                ack_success, missing_bytes = self._wait_for_ack(size, timeout=60)
+                # Esperar ACK con timeout extendido: más largo que la inactividad del
+                # cliente (60 s), que solo envía ACK_MISSING cuando esta vence
+                ack_success, missing_bytes = self._wait_for_ack(size, timeout=75)
                 
                 if ack_success:
                     logging.info("🎉 ¡TRANSMISIÓN ROBUSTA COMPLETADA CON ÉXITO!")
@@ -316,25 +412,22 @@ class UartTransport:
                     break
                 
                 if retry >= max_retries:
-                    logging.error(f"❌ Máximo de reintentos alcanzado ({max_retries})")
+                    logging.error("❌ Máximo de reintentos alcanzado (%d)", max_retries)
                     break
                 
                 # Calcular offset y retransmitir
                 received_bytes = size - missing_bytes
-                success = self._send_missing_bytes(data, received_bytes, missing_bytes)
+                success = self._send_missing_bytes(data, received_bytes, missing_bytes, chunk_size)
                 
                 if not success:
                     logging.error("❌ Falló retransmisión")
                     break
-                    
-                # Pausa antes del siguiente ciclo ACK
-                time.sleep(1.0)
             
             logging.error("❌ Transmisión falló después de todos los reintentos")
             return False
             
         except Exception as e:
-            logging.error(f"❌ Error crítico en envío robusto: {e}")
+            logging.error("❌ Error crítico en envío robusto: %s", e)
             return False
 
     # Métodos de compatibilidad
@@ -343,7 +436,13 @@ class UartTransport:
         return self.send_bytes_robust(data, **kwargs)
 
     def send_file(self, path: str, **kwargs) -> bool:
-        """Envío de archivo robusto"""
+        """Envío de archivo robusto (mapeado en memoria, sin copiarlo a un bytes)"""
         with open(path, "rb") as f:
-            data = f.read()
-        return self.send_bytes_robust(data, **kwargs)
+            if os.fstat(f.fileno()).st_size == 0:
+                return self.send_bytes_robust(b"", **kwargs)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Lectura anticipada asíncrona: el kernel trae el archivo a memoria
+                # mientras se espera ACK_READY del cliente
+                if hasattr(mmap, "MADV_WILLNEED"):
+                    mm.madvise(mmap.MADV_WILLNEED)
+                return self.send_bytes_robust(mm, **kwargs)
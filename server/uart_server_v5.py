@@ -13,39 +13,77 @@ import argparse
 import logging
 import os, sys
 import re
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "APIs"))
 
-from photo_api import capture_photo, capture_to_file
+from photo_api import capture_photo, capture_to_file, stop_stream
 from transport_api import UartTransport
 
 # Log
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
-# Comandos (igual que antes)
-RE_FOTO      = re.compile(r"^<FOTO:\{size_name:(\w+)\}>$")
-RE_CAPTURAR  = re.compile(r"^<CAPTURAR:\{size_name:(\w+)\}>$")
-RE_ENVIAR    = re.compile(r"^<ENVIAR:\{path:([^}]+)\}>$")
+# Comandos: una sola expresión con alternancia (FOTO primero, el caso común)
+# Tolera espacios y CR/LF alrededor, así se aplica a la línea cruda sin strip()
+RE_CMD = re.compile(r"^\s*<(?P<cmd>FOTO|CAPTURAR|ENVIAR):\{(?:size_name:(?P<size>\w+)|path:(?P<path>[^}]+))\}>\s*$")
 
-RESP_OK  = "OK|"
-RESP_BAD = "BAD|"
+# Respuestas ya codificadas (todo ASCII)
+RESP_OK_FMT   = b"OK|%d\r\n"
+RESP_NO_IMAGE = b"BAD|NO_IMAGE\r\n"
+RESP_NO_FILE  = b"BAD|NO_FILE\r\n"
+RESP_BUSY     = b"BUSY\r\n"  # Latido: captura en curso, el OK|size llega después
+BUSY_INTERVAL_S = 2.0  # Período del latido BUSY mientras dura la captura
 
 DEFAULT_LAST = "/tmp/last.jpg"
 
+# Trabajo en segundo plano: captura de FOTO y guardado de la última imagen
+_EXEC = ThreadPoolExecutor(max_workers=2)
+
+# Códigos de comando: índice directo en la tabla de handlers de serve()
+CMD_FOTO, CMD_CAPTURAR, CMD_ENVIAR = 0, 1, 2
+_CMD_CODES = {"FOTO": CMD_FOTO, "CAPTURAR": CMD_CAPTURAR, "ENVIAR": CMD_ENVIAR}
+
 def parse_command(line: str):
-    """Parseo de comandos (sin cambios)"""
-    line = line.strip()
-    m = RE_FOTO.match(line)
-    if m: return ("FOTO", m.group(1))
-    m = RE_CAPTURAR.match(line)
-    if m: return ("CAPTURAR", m.group(1))
-    m = RE_ENVIAR.match(line)
-    if m: return ("ENVIAR", m.group(1))
-    return (None, None)
+    """Parseo de comandos en una sola pasada; retorna (código, argumento)"""
+    m = RE_CMD.match(line)
+    if not m:
+        return (None, None)
+    cmd = _CMD_CODES[m.group("cmd")]
+    # ENVIAR lleva path; FOTO y CAPTURAR llevan size_name
+    arg = m.group("path") if cmd == CMD_ENVIAR else m.group("size")
+    if arg is None:
+        return (None, None)
+    return (cmd, arg)
+
+def _save_last(fd: int, data: bytes):
+    """Guardar la última FOTO en DEFAULT_LAST sobre un fd abierto (en un hilo aparte).
+
+    Se escribe en el lugar y luego se recorta al nuevo tamaño, sin reabrir el archivo.
+    """
+    try:
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+        logging.debug("💾 Imagen guardada como última: %s", DEFAULT_LAST)
+    except Exception as e:
+        logging.warning("⚠️ No se pudo guardar como última: %s", e)
+
+def _open_last(fd: int | None) -> int:
+    """fd de DEFAULT_LAST listo para reescribir; se reabre si el archivo fue
+    reemplazado o borrado (p. ej. por CAPTURAR) para no escribir en un inodo huérfano.
+    """
+    if fd is not None:
+        try:
+            st, cur = os.fstat(fd), os.stat(DEFAULT_LAST)
+            if (st.st_dev, st.st_ino) == (cur.st_dev, cur.st_ino):
+                return fd
+        except OSError:
+            pass
+        os.close(fd)
+    return os.open(DEFAULT_LAST, os.O_WRONLY | os.O_CREAT, 0o644)
 
 def serve(port: str, baud: int, rtscts: bool, xonxoff: bool,
                 use_camera: bool, fallback_image: str | None,
-                inter_chunk_sleep_ms: int):
+                inter_chunk_sleep_ms: int, camera_stream: bool = False):
     """Servidor  con protocolo ACK"""
     
     # CAMBIO PRINCIPAL: Usar UartTransport en lugar de UartTransport
@@ -56,99 +94,126 @@ def serve(port: str, baud: int, rtscts: bool, xonxoff: bool,
     if not uart.connect():
         return
 
+    last_writer = None  # Future del guardado de la última FOTO en DEFAULT_LAST
+    last_fd = None      # fd de DEFAULT_LAST, reutilizado mientras siga siendo el mismo archivo
     try:
-        ser = uart.ser  # acceso crudo para leer comandos
+        ser = uart.ser  # acceso crudo para escribir respuestas
         assert ser is not None
+        # Métodos ligados una sola vez fuera del bucle. Las respuestas no se
+        # drenan con flush(): el envío posterior espera ACK_READY del cliente,
+        # que solo llega después de que éste lea el OK|size
+        write, read_line = ser.write, uart.read_line
+
+        def handle_capturar(arg: str):
+            logging.info("🎯 CAPTURAR %s", arg)
+            size = capture_to_file(DEFAULT_LAST, size_name=arg, use_camera=use_camera,
+                                   fallback_image=fallback_image, timeout_s=8,
+                                   use_stream=camera_stream)
+            if size:
+                write(RESP_OK_FMT % size)
+                logging.info("✅ CAPTURAR exitoso: %d bytes guardados", size)
+            else:
+                write(RESP_NO_IMAGE)
+                logging.error("❌ CAPTURAR falló")
+
+        def handle_enviar(arg: str):
+            path = DEFAULT_LAST if arg == "LAST" else arg
+            if not os.path.isfile(path):
+                write(RESP_NO_FILE)
+                logging.error("❌ ENVIAR: archivo no existe: %s", path)
+                return
+                
+            size = os.path.getsize(path)
+            write(RESP_OK_FMT % size)
+            logging.info("📤 ENVIAR iniciado: %s (%d bytes)", path, size)
+            
+            ok = uart.send_file(
+                path,
+                inter_chunk_sleep_ms=inter_chunk_sleep_ms,
+                max_retries=2,
+                wait_client_ready=True
+            )
+            
+            if ok:
+                logging.info("🎉 ENVIAR  completado exitosamente")
+            else:
+                logging.error("❌ ENVIAR falló")
+
+        def handle_foto(arg: str):
+            nonlocal last_writer, last_fd
+            logging.info("📸 FOTO %s (capturar+enviar)", arg)
+            # La captura corre en el pool; mientras tanto se repite BUSY cada
+            # BUSY_INTERVAL_S para que el cliente renueve su timeout de respuesta
+            capture = _EXEC.submit(capture_photo, arg, use_camera=use_camera, fallback_image=fallback_image,
+                                   timeout_s=8, use_stream=camera_stream)
+            while True:
+                write(RESP_BUSY)
+                try:
+                    data = capture.result(timeout=BUSY_INTERVAL_S)
+                    break
+                except FutureTimeout:
+                    pass
+            if not data:
+                write(RESP_NO_IMAGE)
+                logging.error("❌ FOTO: no se pudo capturar imagen")
+                return
+            
+            # Respuesta OK|size
+            write(RESP_OK_FMT % len(data))
+            logging.info("📤 FOTO iniciado: captura de %d bytes", len(data))
+
+            # Guardar como última imagen (para ENVIAR posterior) en paralelo al envío
+            try:
+                last_fd = _open_last(last_fd)
+            except OSError as e:
+                last_fd = None
+                logging.warning("⚠️ No se pudo guardar como última: %s", e)
+            else:
+                last_writer = _EXEC.submit(_save_last, last_fd, data)
+            
+            ok = uart.send_bytes(
+                data, 
+                inter_chunk_sleep_ms=inter_chunk_sleep_ms,
+                max_retries=2,
+                wait_client_ready=True
+            )
+            
+            if ok:
+                logging.info("🎉 FOTO completada exitosamente")
+            else:
+                logging.error("❌ FOTO  falló")
+
+        # Tabla de despacho indexada por código (orden de CMD_FOTO, CMD_CAPTURAR, CMD_ENVIAR)
+        handlers = (handle_foto, handle_capturar, handle_enviar)
 
         logging.info("🟢 Servidor esperando comandos...")
         while True:
-            # Leer comandos línea por línea
-            line = ser.readline().decode("utf-8", errors="ignore")
-            if not line:
+            # Leer comandos línea por línea (poll sobre el fd, sin lectura byte a byte)
+            raw = read_line()
+            if not raw:
                 continue
+            line = raw.decode("utf-8", errors="ignore")
 
             cmd, arg = parse_command(line)
-            if not cmd:
-                logging.debug(f"(ruido) {line.strip()!r}")
+            if cmd is None:
+                logging.debug("(ruido) %r", line.strip())
                 continue
 
-            if cmd == "CAPTURAR":
-                logging.info(f"🎯 CAPTURAR {arg}")
-                if capture_to_file(DEFAULT_LAST, size_name=arg, use_camera=use_camera,
-                                   fallback_image=fallback_image, timeout_s=8):
-                    size = os.path.getsize(DEFAULT_LAST)
-                    ser.write(f"{RESP_OK}{size}\r\n".encode("utf-8"))
-                    ser.flush()
-                    logging.info(f"✅ CAPTURAR exitoso: {size} bytes guardados")
-                else:
-                    ser.write(f"{RESP_BAD}NO_IMAGE\r\n".encode("utf-8"))
-                    ser.flush()
-                    logging.error("❌ CAPTURAR falló")
-
-            elif cmd == "ENVIAR":
-                path = DEFAULT_LAST if arg == "LAST" else arg
-                if not os.path.isfile(path):
-                    ser.write(f"{RESP_BAD}NO_FILE\r\n".encode("utf-8"))
-                    ser.flush()
-                    logging.error(f"❌ ENVIAR: archivo no existe: {path}")
-                    continue
-                    
-                size = os.path.getsize(path)
-                ser.write(f"{RESP_OK}{size}\r\n".encode("utf-8"))
-                ser.flush()
-                logging.info(f"📤 ENVIAR iniciado: {path} ({size} bytes)")
-                
-                # CAMBIO: Usar el método 
-                ok = uart.send_bytes(
-                    open(path, 'rb').read(),
-                    inter_chunk_sleep_ms=inter_chunk_sleep_ms,
-                    max_retries=2,
-                    wait_client_ready=True
-                )
-                
-                if ok:
-                    logging.info("🎉 ENVIAR  completado exitosamente")
-                else:
-                    logging.error("❌ ENVIAR falló")
-
-            elif cmd == "FOTO":
-                logging.info(f"📸 FOTO {arg} (capturar+enviar)")
-                data = capture_photo(arg, use_camera=use_camera, fallback_image=fallback_image, timeout_s=8)
-                if not data:
-                    ser.write(f"{RESP_BAD}NO_IMAGE\r\n".encode("utf-8"))
-                    ser.flush()
-                    logging.error("❌ FOTO: no se pudo capturar imagen")
-                    continue
-                
-                # Respuesta OK|size
-                ser.write(f"{RESP_OK}{len(data)}\r\n".encode("utf-8"))
-                ser.flush()
-                logging.info(f"📤 FOTO iniciado: captura de {len(data)} bytes")
-                
-                # CAMBIO: Usar envío 
-                ok = uart.send_bytes(
-                    data, 
-                    inter_chunk_sleep_ms=inter_chunk_sleep_ms,
-                    max_retries=2,
-                    wait_client_ready=True
-                )
-                
-                if ok:
-                    # Guardar como última imagen (para comando ENVIAR posterior)
-                    try:
-                        with open(DEFAULT_LAST, "wb") as f:
-                            f.write(data)
-                        logging.debug(f"💾 Imagen guardada como última: {DEFAULT_LAST}")
-                    except Exception as e:
-                        logging.warning(f"⚠️ No se pudo guardar como última: {e}")
-                    
-                    logging.info("🎉 FOTO completada exitosamente")
-                else:
-                    logging.error("❌ FOTO  falló")
+            # CAPTURAR y ENVIAR usan DEFAULT_LAST: esperar a que termine de guardarse
+            if last_writer is not None:
+                last_writer.result()
+                last_writer = None
+
+            handlers[cmd](arg)
                     
     except KeyboardInterrupt:
         logging.info("🛑 Servidor detenido por usuario")
     finally:
+        if last_writer is not None:
+            last_writer.result()
+        if last_fd is not None:
+            os.close(last_fd)
+        stop_stream()
         uart.close()
 
 def main():
@@ -159,7 +224,9 @@ def main():
     ap.add_argument("--xonxoff", action="store_true")
     ap.add_argument("--no-camera", dest="use_camera", action="store_false")
     ap.add_argument("--fallback-image")
-    ap.add_argument("--sleep-ms", type=int, default=1, 
+    ap.add_argument("--camera-stream", action="store_true",
+                    help="Mantener rpicam-vid MJPEG abierto y tomar cuadros del stream")
+    ap.add_argument("--sleep-ms", type=int, default=0, 
                     help="Pausa entre chunks (ms) - con protocolo es menos crítico")
     args = ap.parse_args()
 
@@ -170,11 +237,12 @@ def main():
     print(f"Flow control: RTS/CTS={args.rtscts}, XON/XOFF={args.xonxoff}")
     print(f"Cámara: {'SÍ' if args.use_camera else 'NO'}")
     print(f"Fallback: {args.fallback_image or 'Ninguno'}")
+    print(f"Stream de cámara: {'SÍ' if args.camera_stream else 'NO'}")
     print(f"Sleep entre chunks: {args.sleep_ms}ms")
     print("=" * 70)
 
     serve(args.port, args.baud, args.rtscts, args.xonxoff,
-                args.use_camera, args.fallback_image, args.sleep_ms)
+                args.use_camera, args.fallback_image, args.sleep_ms, args.camera_stream)
 
 if __name__ == "__main__":
     main()
@@ -29,15 +29,13 @@ def send_command(ser, command, expect_response=True, timeout=5):
         if not expect_response:
             return True, "No response expected"
         
-        # Esperar respuesta
+        # Esperar respuesta: readline bloquea hasta el \n o el timeout del puerto
         start_time = time.time()
         while time.time() - start_time < timeout:
-            if ser.in_waiting > 0:
-                response = ser.readline().decode('utf-8', errors='ignore').strip()
-                if response:
-                    log(f"📨 Recibido: '{response}'")
-                    return True, response
-            time.sleep(0.1)
+            response = ser.readline().decode('utf-8', errors='ignore').strip()
+            if response:
+                log(f"📨 Recibido: '{response}'")
+                return True, response
         
         log(f"⏰ Timeout esperando respuesta a '{command}'")
         return False, "TIMEOUT"
@@ -46,7 +44,7 @@ def send_command(ser, command, expect_response=True, timeout=5):
         log(f"❌ Error enviando '{command}': {e}")
         return False, str(e)
 
-def test_uart_client(port="/dev/serial0", baud=57600, timeout=2):
+def test_uart_client(port="/dev/serial0", baud=57600, timeout=2, rtscts=True, xonxoff=False):
     log(f"🚀 Iniciando cliente de test UART en {port} @ {baud}")
     
     try:
@@ -58,15 +56,13 @@ def test_uart_client(port="/dev/serial0", baud=57600, timeout=2):
             stopbits=serial.STOPBITS_ONE,
             bytesize=serial.EIGHTBITS,
             timeout=timeout,
-            rtscts=True,  # RTS/CTS por defecto
-            xonxoff=False
+            rtscts=rtscts,  # RTS/CTS por defecto
+            xonxoff=xonxoff
         )
         
-        # Limpiar buffers
-        for _ in range(3):
-            ser.reset_input_buffer()
-            ser.reset_output_buffer()
-            time.sleep(0.1)
+        # Limpiar buffers (una vez basta)
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
         
         log(f"✅ Puerto configurado: {ser}")
         log("🧪 Iniciando secuencia de tests...")
@@ -187,7 +183,7 @@ def test_uart_client(port="/dev/serial0", baud=57600, timeout=2):
         except:
             pass
 
-def interactive_mode(port, baud, timeout):
+def interactive_mode(port, baud, timeout, rtscts=True, xonxoff=False):
     """Modo interactivo para enviar comandos manualmente"""
     log("🎮 Modo interactivo activado")
     log("💡 Comandos: PING, ECHO <texto>, DATA, STATUS, QUIT")
@@ -197,13 +193,11 @@ def interactive_mode(port, baud, timeout):
         ser = serial.Serial(
             port=port, baudrate=baud, timeout=timeout,
             parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
-            bytesize=serial.EIGHTBITS, rtscts=True, xonxoff=False
+            bytesize=serial.EIGHTBITS, rtscts=rtscts, xonxoff=xonxoff
         )
         
-        for _ in range(3):
-            ser.reset_input_buffer()
-            ser.reset_output_buffer()
-            time.sleep(0.1)
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
         
         log(f"✅ Puerto configurado para modo interactivo")
         
@@ -255,21 +249,14 @@ def main():
     print("=" * 60)
     print()
     
-    # Configurar RTS/CTS según argumentos
-    if args.no_rts:
-        import serial
-        original_serial = serial.Serial
-        def patched_serial(*a, **kw):
-            kw['rtscts'] = False
-            kw['xonxoff'] = True
-            return original_serial(*a, **kw)
-        serial.Serial = patched_serial
+    # Control de flujo según argumentos: sin RTS/CTS se usa XON/XOFF
+    flow = dict(rtscts=not args.no_rts, xonxoff=args.no_rts)
     
     try:
         if args.interactive:
-            interactive_mode(args.port, args.baud, args.timeout)
+            interactive_mode(args.port, args.baud, args.timeout, **flow)
         else:
-            success = test_uart_client(args.port, args.baud, args.timeout)
+            success = test_uart_client(args.port, args.baud, args.timeout, **flow)
             if success:
                 print("\n🎉 ¡TEST DE CLIENTE COMPLETADO EXITOSAMENTE!")
                 print("✅ La comunicación UART funciona correctamente")
@@ -6,8 +6,9 @@ Funciones: Escucha comandos y responde con confirmaciones
 """
 
 import serial
-import time
 import sys
+import os
+import select
 import argparse
 from datetime import datetime
 
@@ -15,7 +16,7 @@ def log(msg):
     timestamp = datetime.now().strftime("%H:%M:%S")
     print(f"[{timestamp}] SERVER: {msg}")
 
-def test_uart_server(port="/dev/serial0", baud=57600, timeout=2):
+def test_uart_server(port="/dev/serial0", baud=57600, timeout=2, rtscts=True, xonxoff=False):
     log(f"🚀 Iniciando servidor de test UART en {port} @ {baud}")
     
     try:
@@ -27,26 +28,42 @@ def test_uart_server(port="/dev/serial0", baud=57600, timeout=2):
             stopbits=serial.STOPBITS_ONE,
             bytesize=serial.EIGHTBITS,
             timeout=timeout,
-            rtscts=True,  # RTS/CTS por defecto
-            xonxoff=False
+            rtscts=rtscts,  # RTS/CTS por defecto
+            xonxoff=xonxoff
         )
         
-        # Limpiar buffers
-        for _ in range(3):
-            ser.reset_input_buffer()
-            ser.reset_output_buffer()
-            time.sleep(0.1)
+        # Limpiar buffers (una vez basta)
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
         
         log(f"✅ Puerto configurado: {ser}")
         log("🟢 Esperando comandos del cliente...")
         log("💡 Comandos disponibles: PING, ECHO, DATA, QUIT")
         
         message_count = 0
+        fd = ser.fileno()
+        buf = bytearray()
+        lines = []
+        out = bytearray()  # Respuestas acumuladas de la ráfaga actual
         
         while True:
             try:
-                # Leer línea del cliente
-                line = ser.readline().decode('utf-8', errors='ignore').strip()
+                # Esperar datos con select() y leer todo lo disponible de una vez
+                if not lines:
+                    # Ráfaga procesada: todas sus respuestas en una sola escritura
+                    if out:
+                        ser.write(out)
+                        ser.flush()
+                        out.clear()
+                    r, _, _ = select.select([fd], [], [], 1.0)
+                    if r:
+                        buf += os.read(fd, 4096)
+                        *lines, rest = buf.split(b"\n")
+                        buf = bytearray(rest)
+                    continue
+                
+                # Siguiente línea completa del cliente
+                line = lines.pop(0).decode('utf-8', errors='ignore').strip()
                 
                 if not line:
                     continue
@@ -57,44 +74,43 @@ def test_uart_server(port="/dev/serial0", baud=57600, timeout=2):
                 # Procesar comandos
                 if line.upper() == "PING":
                     response = "PONG"
-                    ser.write(f"{response}\r\n".encode('utf-8'))
+                    out += f"{response}\r\n".encode('utf-8')
                     log(f"📤 Respondido: {response}")
                     
                 elif line.upper().startswith("ECHO"):
                     # Eco del mensaje
                     echo_text = line[5:] if len(line) > 5 else "VACIO"
                     response = f"ECO: {echo_text}"
-                    ser.write(f"{response}\r\n".encode('utf-8'))
+                    out += f"{response}\r\n".encode('utf-8')
                     log(f"📤 Eco enviado: {response}")
                     
                 elif line.upper() == "DATA":
                     # Enviar datos de prueba
                     test_data = f"DATOS_PRUEBA_{message_count}_{datetime.now().strftime('%H%M%S')}"
-                    ser.write(f"{test_data}\r\n".encode('utf-8'))
+                    out += f"{test_data}\r\n".encode('utf-8')
                     log(f"📤 Datos enviados: {test_data}")
                     
                 elif line.upper() == "STATUS":
                     # Enviar status del servidor
                     status = f"OK|MSGS:{message_count}|TIME:{datetime.now().strftime('%H:%M:%S')}"
-                    ser.write(f"{status}\r\n".encode('utf-8'))
+                    out += f"{status}\r\n".encode('utf-8')
                     log(f"📤 Status enviado: {status}")
                     
                 elif line.upper() == "QUIT":
                     response = "BYE"
-                    ser.write(f"{response}\r\n".encode('utf-8'))
+                    out += f"{response}\r\n".encode('utf-8')
                     log(f"📤 Despedida enviada: {response}")
                     log("🛑 Cliente solicitó terminar")
+                    ser.write(out)
+                    ser.flush()
                     break
                     
                 else:
                     # Comando desconocido
                     response = f"UNKNOWN_CMD: {line}"
-                    ser.write(f"{response}\r\n".encode('utf-8'))
+                    out += f"{response}\r\n".encode('utf-8')
                     log(f"⚠️ Comando desconocido: {line}")
                 
-                ser.flush()
-                time.sleep(0.1)  # Pequeña pausa entre respuestas
-                
             except UnicodeDecodeError:
                 log("⚠️ Error decodificando mensaje recibido")
             except serial.SerialException as e:
@@ -138,19 +154,11 @@ def main():
     print("=" * 60)
     print()
     
-    # Configurar RTS/CTS según argumentos
-    if args.no_rts:
-        import serial
-        # Monkey patch para deshabilitar RTS/CTS en la función
-        original_serial = serial.Serial
-        def patched_serial(*a, **kw):
-            kw['rtscts'] = False
-            kw['xonxoff'] = True  # Usar XON/XOFF en su lugar
-            return original_serial(*a, **kw)
-        serial.Serial = patched_serial
+    # Control de flujo según argumentos: sin RTS/CTS se usa XON/XOFF
+    flow = dict(rtscts=not args.no_rts, xonxoff=args.no_rts)
     
     try:
-        success = test_uart_server(args.port, args.baud, args.timeout)
+        success = test_uart_server(args.port, args.baud, args.timeout, **flow)
         if success:
             print("\n✅ Test de servidor completado exitosamente")
         else: